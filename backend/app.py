@@ -1,6 +1,7 @@
 from fastapi import FastAPI, HTTPException, BackgroundTasks
 from pydantic import BaseModel
 from fastapi.middleware.cors import CORSMiddleware
+import asyncio
 import os
 
 # We import our new optimized pipeline
@@ -60,19 +61,21 @@ async def ask_question(body: Question):
     return response
 
 @app.post("/reset")
-def reset():
+async def reset():
     """
     Completely reset the vector database.
+    Chroma/SQLite work runs in a worker thread so other requests keep flowing.
     """
-    reset_db()
+    await asyncio.to_thread(reset_db)
     return {"message": "Database reset successfully"}
 
 @app.get("/documents")
-def documents():
+async def documents():
     """
     List indexed documents and chunk counts.
+    Chroma/SQLite work runs in a worker thread so other requests keep flowing.
     """
-    return list_documents()
+    return await asyncio.to_thread(list_documents)
 
 @app.get("/health")
 def health():
@@ -1,10 +1,34 @@
+import asyncio
+import os
+import httpx
 import ollama
-from typing import List, Optional
+from collections import OrderedDict
+from typing import List, Optional, Tuple
 
 #EMBED_MODEL = "nomic-embed-text"
 EMBED_MODEL = "all-minilm"
-# Pre-instantiate client to reuse connection pools if supported by the version
-client = ollama.Client()
+# Keep-alive pool shared by every request a client makes. ollama.Client forwards
+# extra kwargs to its underlying httpx client, which is thread-safe, so any
+# thread calling embed() or embed_batch() can share one instance.
+OLLAMA_TIMEOUT = 300
+HTTP_LIMITS = httpx.Limits(
+    max_keepalive_connections=int(os.getenv("OLLAMA_MAX_KEEPALIVE", "40")),
+    max_connections=int(os.getenv("OLLAMA_MAX_CONNECTIONS", "100")),
+    keepalive_expiry=30,
+)
+# Pre-instantiate client once so TCP connections are reused across calls.
+# Only the sync helpers use it; ingestion embeds through embed_batch_async.
+client = ollama.Client(timeout=OLLAMA_TIMEOUT, limits=HTTP_LIMITS)
+# Async client for the FastAPI event loop (query-time embeddings in /ask).
+# Ingestion creates its own per-loop client in embed_batch_async.
+async_client = ollama.AsyncClient(timeout=OLLAMA_TIMEOUT, limits=HTTP_LIMITS)
+# Texts per /api/embed request; keeps payloads under Ollama's request limits
+EMBED_BATCH_SIZE = 64
+# Max concurrent /api/embed requests; match the server's OLLAMA_NUM_PARALLEL
+MAX_PARALLEL = int(os.getenv("OLLAMA_NUM_PARALLEL", "4"))
+# Recent query embeddings, keyed by whitespace-normalized query text (LRU)
+QUERY_CACHE_SIZE = 1024
+_query_cache: "OrderedDict[str, Tuple[float, ...]]" = OrderedDict()
 
 def embed(text: str) -> Optional[List[float]]:
     """
@@ -19,35 +43,146 @@ def embed(text: str) -> Optional[List[float]]:
         return None
 
     try:
-        response = client.embeddings(
+        # Same /api/embed endpoint as the batch path so vectors are comparable
+        response = client.embed(
             model=EMBED_MODEL,
-            prompt=text
+            input=text
         )
-        return response.get("embedding")
+        embeddings = response.get("embeddings")
+        return embeddings[0] if embeddings else None
     except Exception as e:
         print(f"Error embedding text: {e}")
         return None
 
-def embed_batch(texts: List[str]) -> List[List[float]]:
+async def embed_async(text: str) -> Optional[List[float]]:
+    """
+    Async version of embed for the request path.
+    Top 1% Improvement: Awaits Ollama instead of blocking the event loop,
+    so concurrent /ask requests don't stall each other. Repeated questions
+    are served from an in-memory LRU cache without calling Ollama at all.
+    """
+    if not text or not isinstance(text, str):
+        return None
+
+    # Normalize whitespace so trivially different spellings share a cache slot
+    key = " ".join(text.split())
+    if not key:
+        return None
+
+    cached = _query_cache.get(key)
+    if cached is not None:
+        _query_cache.move_to_end(key)
+        return list(cached)
+
+    try:
+        response = await async_client.embed(
+            model=EMBED_MODEL,
+            input=key
+        )
+        embeddings = response.get("embeddings")
+        if not embeddings:
+            return None
+    except Exception as e:
+        print(f"Error embedding text: {e}")
+        return None
+
+    # Tuples are immutable, so callers can't corrupt the cached vector
+    _query_cache[key] = tuple(embeddings[0])
+    if len(_query_cache) > QUERY_CACHE_SIZE:
+        _query_cache.popitem(last=False)
+    return embeddings[0]
+
+def embed_batch(texts: List[str]) -> List[Optional[List[float]]]:
     """
     Generates embeddings for a list of strings.
-    Top 1% Improvement: Handles lists to reduce function call overhead 
-    and prepares for parallel processing in ingest.py.
-    """
-    results = []
-    # Note: If/when Ollama supports native batching in the API, 
-    # we would replace this loop with a single call.
-    # For now, we clean the inputs and process.
-    valid_texts = [t.strip() for t in texts if t and t.strip()]
-    
-    if not valid_texts:
-        return []
-
-    # We will optimize the concurrency in the ingest layer, 
-    # but this function ensures clean abstraction.
-    for text in valid_texts:
-        emb = embed(text)
-        if emb:
-            results.append(emb)
-            
+    Top 1% Improvement: Uses Ollama's native /api/embed batch endpoint,
+    so N chunks cost ceil(N / EMBED_BATCH_SIZE) round-trips instead of N.
+    The result is aligned with the input: entry i is the embedding of
+    texts[i], or None if that text was empty or its sub-batch failed.
+    Kept as public API for synchronous callers; the ingestion pipeline
+    uses embed_batch_async instead.
+    """
+    results: List[Optional[List[float]]] = [None] * len(texts)
+
+    # Clean inputs but remember where each one came from
+    valid = [(i, t.strip()) for i, t in enumerate(texts) if t and isinstance(t, str) and t.strip()]
+    if not valid:
+        return results
+
+    # Sub-batch to stay under Ollama's request size limits
+    for start in range(0, len(valid), EMBED_BATCH_SIZE):
+        sub_batch = valid[start:start + EMBED_BATCH_SIZE]
+        try:
+            response = client.embed(
+                model=EMBED_MODEL,
+                input=[t for _, t in sub_batch]
+            )
+            # Ollama returns embeddings in input order
+            for (i, _), emb in zip(sub_batch, response["embeddings"]):
+                results[i] = emb
+        except Exception as e:
+            print(f"Error embedding batch of {len(sub_batch)} texts: {e}")
+
+    return results
+
+def new_async_client() -> ollama.AsyncClient:
+    """
+    AsyncClient with the shared pool settings, for use on a single event loop.
+    Close it with close_async_client before that loop ends.
+    """
+    return ollama.AsyncClient(timeout=OLLAMA_TIMEOUT, limits=HTTP_LIMITS)
+
+async def close_async_client(aclient: ollama.AsyncClient):
+    """Closes the client's httpx connections while their event loop is still running."""
+    await aclient._client.aclose()
+
+async def embed_batch_async(
+    texts: List[str],
+    aclient: Optional[ollama.AsyncClient] = None,
+    semaphore: Optional[asyncio.Semaphore] = None
+) -> List[Optional[List[float]]]:
+    """
+    Async version of embed_batch.
+    Top 1% Improvement: Fires the sub-batches concurrently with asyncio.gather
+    so Ollama's parallel workers (OLLAMA_NUM_PARALLEL) are all kept busy.
+    Same contract as embed_batch: results are aligned with the input.
+    Long-running callers on one loop can pass their own client and semaphore
+    so connections and the concurrency cap are shared across calls.
+    """
+    results: List[Optional[List[float]]] = [None] * len(texts)
+
+    valid = [(i, t.strip()) for i, t in enumerate(texts) if t and isinstance(t, str) and t.strip()]
+    if not valid:
+        return results
+
+    # httpx async connections are bound to the event loop that opened them,
+    # so the client (and the semaphore) must belong to the running loop.
+    owns_client = aclient is None
+    if owns_client:
+        aclient = new_async_client()
+    if semaphore is None:
+        semaphore = asyncio.Semaphore(MAX_PARALLEL)
+
+    async def embed_sub_batch(sub_batch):
+        async with semaphore:
+            try:
+                response = await aclient.embed(
+                    model=EMBED_MODEL,
+                    input=[t for _, t in sub_batch]
+                )
+                for (i, _), emb in zip(sub_batch, response["embeddings"]):
+                    results[i] = emb
+            except Exception as e:
+                print(f"Error embedding batch of {len(sub_batch)} texts: {e}")
+
+    try:
+        await asyncio.gather(*[
+            embed_sub_batch(valid[start:start + EMBED_BATCH_SIZE])
+            for start in range(0, len(valid), EMBED_BATCH_SIZE)
+        ])
+    finally:
+        # A client we created dies with this call; callers' clients are theirs to close
+        if owns_client:
+            await close_async_client(aclient)
+
     return results
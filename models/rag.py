@@ -1,13 +1,14 @@
+import asyncio
 import ollama
 from typing import Dict, Any, List
 
 # Import our optimized helper to keep code DRY (Don't Repeat Yourself)
 #from .vector_store import query_vectors
-from models.vector_store import query_vectors, get_collection
-from models.embeddings import embed
+from models.vector_store import query_by_vector
+from models.embeddings import embed_async, HTTP_LIMITS, OLLAMA_TIMEOUT
 # Initialize AsyncClient for non-blocking operations
 # This allows handling multiple user requests simultaneously
-client = ollama.AsyncClient()
+client = ollama.AsyncClient(timeout=OLLAMA_TIMEOUT, limits=HTTP_LIMITS)
 
 #GENERATION_MODEL = "qwen2.5:3b"
 GENERATION_MODEL = "qwen2.5:0.5b"
@@ -20,10 +21,13 @@ async def ask(query: str) -> Dict[str, Any]:
         return {"answer": "Please ask a question.", "sources": []}
 
     # 1. Retrieve Context (using our optimized vector store helper)
-    # Note: Vector search is usually CPU bound/fast, so sync is often okay,
-    # but strictly we could wrap it in a thread if the DB is huge. 
-    # For now, the direct call is fine.
-    results = query_vectors(query, n_results=3)
+    # The query embedding is awaited on the AsyncClient, and the blocking
+    # Chroma search runs in a worker thread so the event loop stays free.
+    query_vec = await embed_async(query)
+    if not query_vec:
+        return {"answer": "I don't know based on the available documents.", "sources": []}
+
+    results = await asyncio.to_thread(query_by_vector, query_vec, 3)
 
     # Handle empty results safely
     if not results or not results["documents"] or not results["documents"][0]:
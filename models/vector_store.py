@@ -1,14 +1,41 @@
+import asyncio
 import chromadb
+import hashlib
 import os
-import uuid
-from typing import List, Dict, Any
-from models.embeddings import embed_batch
+import sqlite3
+import threading
+import numpy as np
+from collections import OrderedDict
+from typing import List, Dict, Any, Optional
+from models.embeddings import embed_batch_async
 #from .embeddings import embed_batch  # Using our new optimized batch function
 
 DB_PATH = os.path.abspath("db")
+# Content hashes of files already embedded, so re-runs skip unchanged files
+INGESTED_DB = os.path.join(DB_PATH, "ingested.sqlite3")
+UPSERT_BATCH_SIZE = 250  # Max chunks per Chroma upsert; Chroma's sweet spot is 50-250
 
 # SINGLETON PATTERN: Initialize client once to avoid overhead on every call
 _client_instance = None
+_collection_instance = None
+
+# Top-k results for recent query vectors (LRU). Cleared whenever the
+# collection changes so answers never come from a stale index.
+RESULTS_CACHE_SIZE = 256
+_results_cache: "OrderedDict[tuple, Any]" = OrderedDict()
+_results_lock = threading.Lock()  # query_by_vector runs in worker threads
+# Bumped on every clear, so a query that started before a write can tell
+# its results are stale and skip caching them
+_results_generation = 0
+# Bumped by reset_db, so ingestion never records files whose chunks a reset wiped
+_reset_generation = 0
+_reset_lock = threading.Lock()
+
+def clear_results_cache():
+    global _results_generation
+    with _results_lock:
+        _results_cache.clear()
+        _results_generation += 1
 
 def get_client():
     """Returns a singleton instance of the PersistentClient."""
@@ -17,72 +44,191 @@ def get_client():
         os.makedirs(DB_PATH, exist_ok=True)
         # Top 1% Tip: Use PersistentClient for stability in production
         _client_instance = chromadb.PersistentClient(path=DB_PATH)
+        _enable_wal(os.path.join(DB_PATH, "chroma.sqlite3"))
     return _client_instance
 
+def _enable_wal(sqlite_path: str):
+    """
+    Switches Chroma's SQLite file to write-ahead logging.
+    WAL turns each batch commit into an append instead of a rollback-journal
+    rewrite, and lets /ask reads proceed while ingestion writes.
+    journal_mode is stored in the database file, so it sticks for Chroma's own
+    connections; per-connection pragmas (synchronous, cache_size, mmap_size)
+    would not, so they are deliberately not set here.
+    """
+    # WAL needs SQLite >= 3.7.0; older builds keep the default journal
+    if sqlite3.sqlite_version_info < (3, 7, 0) or not os.path.exists(sqlite_path):
+        return
+    try:
+        conn = sqlite3.connect(sqlite_path, isolation_level=None)
+        try:
+            conn.execute("PRAGMA journal_mode=WAL")
+        finally:
+            conn.close()
+    except sqlite3.Error as e:
+        print(f"Could not enable WAL on {sqlite_path}: {e}")
+
 def get_collection():
-    client = get_client()
-    # "get_or_create" is safe and efficient
-    return client.get_or_create_collection(name="docs")
+    """Returns a cached handle to the "docs" collection (reset by reset_db)."""
+    global _collection_instance
+    if _collection_instance is None:
+        client = get_client()
+        # "get_or_create" is safe, but hits SQLite, so only do it once
+        _collection_instance = client.get_or_create_collection(name="docs")
+    return _collection_instance
+
+def _ingested_conn():
+    os.makedirs(DB_PATH, exist_ok=True)
+    conn = sqlite3.connect(INGESTED_DB)
+    conn.execute("CREATE TABLE IF NOT EXISTS ingested (hash BLOB PRIMARY KEY, path TEXT)")
+    return conn
+
+def load_ingested_hashes() -> set:
+    """Returns the digests of every file recorded by mark_ingested."""
+    conn = _ingested_conn()
+    try:
+        return {row[0] for row in conn.execute("SELECT hash FROM ingested")}
+    finally:
+        conn.close()
+
+def get_reset_generation() -> int:
+    """Current reset epoch; capture it before writing chunks and pass it to mark_ingested."""
+    with _reset_lock:
+        return _reset_generation
+
+def mark_ingested(entries: List[tuple], generation: Optional[int] = None):
+    """
+    Records (digest, path) pairs for files whose chunks are safely stored.
+    With `generation`, nothing is recorded if reset_db ran since it was
+    captured: those chunks were wiped, so the files must be ingested again.
+    """
+    if not entries:
+        return
+    # Held across the check and the insert so a reset can't slip in between
+    with _reset_lock:
+        if generation is not None and generation != _reset_generation:
+            return
+        conn = _ingested_conn()
+        try:
+            with conn:
+                conn.executemany("INSERT OR IGNORE INTO ingested (hash, path) VALUES (?, ?)", entries)
+        finally:
+            conn.close()
 
 # Open models/vector_store.py and REPLACE the add_documents function
 
-def add_documents(docs: List[Dict[str, Any]]):
+def chunk_id(path: str, text: str) -> str:
+    """
+    Deterministic id for a chunk: the same content from the same file always
+    maps to the same id. The path is part of the key so files sharing a chunk
+    (license headers, boilerplate) each keep their own row.
+    """
+    key = f"{path}\0{text}"
+    return hashlib.blake2b(key.encode("utf-8"), digest_size=16).hexdigest()
+
+def delete_paths(paths: List[str], collection=None):
+    """
+    Removes every stored chunk of the given files.
+    Called before re-ingesting a changed file, so chunks of its old version
+    (whose path/content ids no longer match) don't linger next to the new ones.
+    """
+    if not paths:
+        return
+    if collection is None:
+        collection = get_collection()
+    for path in paths:
+        collection.delete(where={"path": path})
+    clear_results_cache()  # Removed chunks may be in any cached top-k
+
+def add_documents(
+    docs: List[Dict[str, Any]],
+    embeddings: Optional[List[Optional[List[float]]]] = None,
+    collection=None
+):
     """
     Adds documents in BATCHES with safety checks.
     Fixes the 'Number of embeddings must match number of ids' error.
+    Pass pre-computed `embeddings` (aligned with `docs`) to skip embedding here,
+    and a `collection` handle to avoid re-fetching it on every batch.
+    Returns the number of chunks saved.
     """
-    collection = get_collection()
-    
-    valid_docs = [doc for doc in docs if doc.get("content", "").strip()]
-    if not valid_docs:
-        return
+    if collection is None:
+        collection = get_collection()
+
+    # Keep docs and their (optional) pre-computed vectors paired while filtering
+    precomputed = embeddings is not None
+    if not precomputed:
+        embeddings = [None] * len(docs)
+    # Duplicate ids in one upsert are rejected, so keep the first copy of each chunk
+    pairs = []
+    seen_ids = set()
+    for doc, vec in zip(docs, embeddings):
+        if not doc.get("content", "").strip():
+            continue
+        doc_id = chunk_id(doc["path"], doc["content"])
+        if doc_id not in seen_ids:
+            seen_ids.add(doc_id)
+            pairs.append((doc_id, doc, vec))
+    if not pairs:
+        return 0
+
+    valid_docs = [doc for _, doc, _ in pairs]
 
     # 1. Prepare Lists
     texts = [doc["content"] for doc in valid_docs]
     metadatas = [{"path": doc["path"]} for doc in valid_docs]
-    ids = [str(uuid.uuid4()) for _ in valid_docs]
+    ids = [doc_id for doc_id, _, _ in pairs]
 
     # 2. Generate Embeddings (but keep track of failures!)
-    # We cannot use the old embed_batch because it swallows errors silently.
-    # We must embed one by one to know WHICH one failed, or update embed_batch.
-    # For safety on your HDD, we will do a robust loop here.
-    
+    # embed_batch_async returns one entry per input text (None on failure),
+    # so we can zip back to ids/metadatas by index. Sub-batches run concurrently.
+    # Safe to asyncio.run here: ingestion runs in a worker thread, not the server loop.
+    if precomputed:
+        vectors = [vec for _, _, vec in pairs]
+    else:
+        vectors = asyncio.run(embed_batch_async(texts))
+
     final_ids = []
     final_texts = []
     final_embeddings = []
     final_metadatas = []
 
-    from .embeddings import embed  # Import single embed function
-
-    for i, text in enumerate(texts):
-        try:
-            # Generate embedding for THIS specific chunk
-            vec = embed(text)
-            
-            if vec:
-                # ONLY if embedding succeeds, add to the final lists
-                final_ids.append(ids[i])
-                final_texts.append(text)
-                final_embeddings.append(vec)
-                final_metadatas.append(metadatas[i])
-            else:
-                print(f"Skipping chunk {i}: Embedding generation returned None.")
-                
-        except Exception as e:
-            print(f"Failed to embed chunk {i}: {e}")
+    for i, vec in enumerate(vectors):
+        if vec:
+            # ONLY if embedding succeeds, add to the final lists
+            final_ids.append(ids[i])
+            final_texts.append(texts[i])
+            final_embeddings.append(vec)
+            final_metadatas.append(metadatas[i])
+        else:
+            print(f"Skipping chunk {i}: Embedding generation returned None.")
 
     # 3. Batch Insert (Only the valid ones)
-    if final_ids:
+    # Vectors are passed as float32 on purpose: Chroma (0.4.x) re-encodes every
+    # embedding as float32 for both SQLite and the HNSW index, so rounding to
+    # float16 first saves nothing, and per-vector int8 scales would distort
+    # the L2 distances HNSW ranks by.
+    # A single large file can yield thousands of chunks, so cap each upsert
+    # at UPSERT_BATCH_SIZE rather than trusting the caller's batch size.
+    saved = 0
+    for start in range(0, len(final_ids), UPSERT_BATCH_SIZE):
+        end = start + UPSERT_BATCH_SIZE
         try:
-            collection.add(
-                ids=final_ids,
-                documents=final_texts,
-                embeddings=final_embeddings,
-                metadatas=final_metadatas
+            # upsert + path/content-hash ids: re-adding an unchanged chunk overwrites
+            # it; chunks from an edited file's old version are removed by delete_paths
+            collection.upsert(
+                ids=final_ids[start:end],
+                documents=final_texts[start:end],
+                embeddings=final_embeddings[start:end],
+                metadatas=final_metadatas[start:end]
             )
-            print(f"Successfully saved {len(final_ids)} chunks to DB.")
+            saved += len(final_ids[start:end])
         except Exception as e:
             print(f"ChromaDB Insert Error: {e}")
+    if saved:
+        clear_results_cache()  # New chunks may change any top-k
+        print(f"Successfully saved {saved} chunks to DB.")
+    return saved
             
 def query_vectors(query_text: str, n_results: int = 5):
     """
@@ -95,21 +241,60 @@ def query_vectors(query_text: str, n_results: int = 5):
     if not query_vec:
         return []
 
+    return query_by_vector(query_vec, n_results=n_results)
+
+def query_by_vector(query_vec: List[float], n_results: int = 5):
+    """
+    Similarity search for an already-embedded query.
+    Blocking (HNSW + SQLite); async callers should run it via asyncio.to_thread.
+    """
+    # Round to float16 before hashing so near-identical vectors share a key
+    digest = hashlib.sha1(np.asarray(query_vec, dtype=np.float16).tobytes()).hexdigest()
+    key = (digest, n_results)
+    with _results_lock:
+        if key in _results_cache:
+            _results_cache.move_to_end(key)
+            return _results_cache[key]
+        generation = _results_generation
+
     collection = get_collection()
+    # Be explicit: never ship the raw vectors back, rag.py only needs text + metadata
     results = collection.query(
         query_embeddings=[query_vec],
-        n_results=n_results
+        n_results=n_results,
+        include=["documents", "metadatas", "distances"]
     )
+
+    with _results_lock:
+        # The collection changed mid-query: return the results, but don't cache them
+        if generation == _results_generation:
+            _results_cache[key] = results
+            if len(_results_cache) > RESULTS_CACHE_SIZE:
+                _results_cache.popitem(last=False)
     return results
 
 def reset_db():
+    global _collection_instance, _reset_generation
     client = get_client()
+    # Drop the cached handle; it points at the collection we are deleting
+    _collection_instance = None
+    clear_results_cache()
     try:
         client.delete_collection("docs")
     except Exception:
         pass
     # Re-create immediately so it's ready
-    client.get_or_create_collection("docs")
+    _collection_instance = client.get_or_create_collection("docs")
+
+    # Forget ingested files too, otherwise re-indexing would skip them all
+    with _reset_lock:
+        _reset_generation += 1
+        conn = _ingested_conn()
+        try:
+            with conn:
+                conn.execute("DELETE FROM ingested")
+        finally:
+            conn.close()
 
 def list_documents():
     """
@@ -1,21 +1,41 @@
 import re
-from typing import Generator
+from typing import Generator, Iterable, Union
+
+# Compiled once at import instead of looked up in re's cache per call
+_NEWLINE_RE = re.compile(r"\n{3,}")
+
+def _iter_paragraphs(pieces: Iterable[str]) -> Generator[str, None, None]:
+    """
+    Lazily splits a stream of text pieces (e.g. PDF pages) into paragraphs.
+    Each piece boundary is treated as a paragraph break.
+    """
+    for piece in pieces:
+        if not piece:
+            continue
+        # Normalize excessive newlines to ensure clean paragraph separation
+        piece = _NEWLINE_RE.sub("\n\n", piece.strip())
+        for p in piece.split("\n\n"):
+            p = p.strip()
+            if p:
+                yield p
 
 def smart_chunk_text(
-    text: str, 
+    text: Union[str, Iterable[str]], 
     max_chars: int = 1500, 
     overlap_paragraphs: int = 1
 ) -> Generator[str, None, None]:
     """
     Paragraph-aware chunking that respects word boundaries even for huge paragraphs.
     Top 1% Improvement: Uses generators and recursive safe-splitting.
+    Accepts a single string or an iterable of strings (e.g. pages streamed
+    from a PDF), so large files never need to be held in RAM as one string.
     """
     if not text:
         return
 
-    # Normalize excessive newlines to ensure clean paragraph separation
-    text = re.sub(r"\n{3,}", "\n\n", text.strip())
-    paragraphs = [p.strip() for p in text.split("\n\n") if p.strip()]
+    if isinstance(text, str):
+        text = [text]
+    paragraphs = _iter_paragraphs(text)
 
     current_paras = []
     current_length = 0
@@ -38,7 +58,8 @@ def smart_chunk_text(
             while start < para_len:
                 end = start + max_chars
                 if end < para_len:
-                    # Find last space to avoid cutting words
+                    # Find last space to avoid cutting words (window-bounded rfind;
+                    # see chunk_text for why positions are not precomputed)
                     last_space = para.rfind(" ", start, end)
                     if last_space != -1 and last_space > start + (max_chars * 0.5):
                         end = last_space + 1
@@ -63,9 +84,11 @@ def smart_chunk_text(
 
             # Handle Overlap: Keep the last N paragraphs for context
             if overlap_paragraphs > 0:
+                # Update length incrementally: subtract only the dropped paragraphs
+                # (and their separators) instead of re-summing the kept ones
+                dropped = current_paras[:-overlap_paragraphs]
+                current_length -= sum(len(p) for p in dropped) + 2 * len(dropped)
                 current_paras = current_paras[-overlap_paragraphs:]
-                # Recalculate length (expensive but necessary for accuracy)
-                current_length = sum(len(p) for p in current_paras) + (2 * (len(current_paras) - 1)) if current_paras else 0
             else:
                 current_paras = []
                 current_length = 0
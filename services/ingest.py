@@ -1,6 +1,9 @@
+import asyncio
+import hashlib
+import multiprocessing
 import os
-from concurrent.futures import ThreadPoolExecutor, as_completed
-from typing import List, Dict, Any
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Dict, Any, Iterator
 
 # Handling optional dependencies gracefully
 try:
@@ -23,94 +26,135 @@ except ImportError:
 
 # TO THIS (Absolute Imports):
 from services.chunking import smart_chunk_text
-from models.vector_store import add_documents
+from models.vector_store import add_documents, chunk_id, delete_paths, get_reset_generation, load_ingested_hashes, mark_ingested
+from models.embeddings import embed_batch_async, new_async_client, close_async_client, MAX_PARALLEL
 # -------- Constants --------
 MAX_FILE_CHARS = 500_000  # Increased limit, we handle it via chunking
-MAX_WORKERS = min(32, os.cpu_count() + 4)  # Optimal thread count for I/O
+MAX_WORKERS = os.cpu_count() or 1  # One process per core: extraction/chunking is CPU-bound
+INGEST_BATCH_SIZE = 250  # Chunks per embed/write batch; add_documents caps each upsert separately
+WRITE_QUEUE_SIZE = 2  # Embedded batches allowed to wait for the Chroma writer
 
 EXCLUDE_DIRS = {
     ".git", "node_modules", "__pycache__", "venv", ".venv", "dist", "build", ".idea", ".vscode"
 }
 
-SUPPORTED_EXTENSIONS = {
-    ".txt": "text", 
-    ".pdf": "pdf", 
-    ".docx": "docx",
-    ".md": "text", 
-    ".py": "code", 
-    ".js": "code", 
-    ".ts": "code",
-    ".java": "code",
-    ".c": "code",
-    ".cpp": "code"
-}
-
 # -------- File loaders (Optimized) --------
 
+# Loaders raise on failure (including a missing optional dependency) instead
+# of returning nothing, so process_file's caller can tell a failed load apart
+# from a genuinely empty file and never records the failure as ingested.
+
 def load_txt(path):
-    try:
-        with open(path, "r", encoding="utf-8", errors="ignore") as f:
-            return f.read(MAX_FILE_CHARS)
-    except Exception:
-        return ""
+    with open(path, "r", encoding="utf-8", errors="ignore") as f:
+        return f.read(MAX_FILE_CHARS)
 
-def load_pdf(path):
+def load_pdf(path) -> Iterator[str]:
+    """
+    Streams extracted text one page at a time instead of joining all pages,
+    so peak memory stays around one page rather than the whole file.
+    Output is capped at MAX_FILE_CHARS with a running counter.
+    """
     if not PdfReader:
-        print(f"pypdf not installed. Skipping {path}")
-        return ""
-    try:
-        reader = PdfReader(path)
-        # Optimized list comprehension is faster than appending in loop
-        pages = [page.extract_text() for page in reader.pages if page.extract_text()]
-        return "\n\n".join(pages)[:MAX_FILE_CHARS]
-    except Exception as e:
-        print(f"Error reading PDF {path}: {e}")
-        return ""
+        raise ImportError("pypdf not installed")
+    reader = PdfReader(path)
+    remaining = MAX_FILE_CHARS
+    # Pages are extracted serially on purpose: pypdf is pure Python and
+    # holds the GIL, and it is not thread-safe, so per-thread readers
+    # would each hold their own copy of the file. Files already run in
+    # parallel across the process pool.
+    for page in reader.pages:
+        text = page.extract_text()
+        if not text:
+            continue
+        if len(text) >= remaining:
+            yield text[:remaining]
+            return
+        remaining -= len(text)
+        yield text
 
 def load_docx(path):
     if not Document:
-        print(f"python-docx not installed. Skipping {path}")
-        return ""
-    try:
-        doc = Document(path)
-        return "\n\n".join([p.text for p in doc.paragraphs if p.text.strip()])[:MAX_FILE_CHARS]
-    except Exception as e:
-        print(f"Error reading DOCX {path}: {e}")
-        return ""
+        raise ImportError("python-docx not installed")
+    doc = Document(path)
+    return "\n\n".join([p.text for p in doc.paragraphs if p.text.strip()])[:MAX_FILE_CHARS]
 
 def load_code(path):
+    with open(path, "r", encoding="utf-8", errors="ignore") as f:
+        # Read all lines at once
+        content = f.read(MAX_FILE_CHARS)
+        return content
+
+# Single source of truth: ext -> (type, loader). SUPPORTED_EXTENSIONS and
+# _LOADERS are derived from it, so an extension can't be walked and then
+# silently loaded as nothing (and marked ingested with zero chunks).
+_FILE_TYPES = {
+    ".txt": ("text", load_txt),
+    ".pdf": ("pdf", load_pdf),
+    ".docx": ("docx", load_docx),
+    ".md": ("text", load_txt),
+    ".py": ("code", load_code),
+    ".js": ("code", load_code),
+    ".ts": ("code", load_code),
+    ".java": ("code", load_code),
+    ".c": ("code", load_code),
+    ".cpp": ("code", load_code)
+}
+
+SUPPORTED_EXTENSIONS = {ext: kind for ext, (kind, _) in _FILE_TYPES.items()}
+# One dict lookup per file instead of an if-chain
+_LOADERS = {ext: loader for ext, (_, loader) in _FILE_TYPES.items()}
+
+def iter_supported_files(root: str) -> Iterator[str]:
+    """
+    Recursively yields supported file paths under `root`.
+    Uses os.scandir directly: entry types come from the directory listing,
+    so excluded dirs and unsupported extensions are skipped without a stat.
+    """
     try:
-        with open(path, "r", encoding="utf-8", errors="ignore") as f:
-            # Read all lines at once
-            content = f.read(MAX_FILE_CHARS)
-            return content
-    except Exception:
-        return ""
-
-def get_loader(ext):
-    if ext == ".pdf": return load_pdf
-    if ext == ".docx": return load_docx
-    return load_code if ext in [".py", ".js", ".ts", ".c", ".cpp", ".java"] else load_txt
+        with os.scandir(root) as it:
+            entries = list(it)
+    except OSError:
+        # Unreadable directory: skip it, like os.walk does
+        return
+
+    for entry in entries:
+        if entry.is_dir(follow_symlinks=False):
+            if entry.name not in EXCLUDE_DIRS:
+                yield from iter_supported_files(entry.path)
+        else:
+            ext = os.path.splitext(entry.name)[1].lower()
+            if ext in SUPPORTED_EXTENSIONS:
+                yield entry.path
+
+def file_digest(path: str) -> bytes:
+    """SHA-256 of the raw file bytes (hashlib uses SHA-NI / ARMv8 crypto when available)."""
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.digest()
 
 # -------- Main Pipeline --------
 
 def process_file(file_path: str) -> List[Dict[str, Any]]:
     """
     Loads a single file AND chunks it immediately.
-    Returns a list of chunk dictionaries ready for the DB.
+    Returns a list of chunk dictionaries ready for the DB; an empty list means
+    the file loaded fine but had no text. Loader errors propagate.
     """
     ext = os.path.splitext(file_path)[1].lower()
-    if ext not in SUPPORTED_EXTENSIONS:
+    loader = _LOADERS.get(ext)
+    if loader is None:
         return []
 
-    loader = get_loader(ext)
     content = loader(file_path)
 
-    if not content or not content.strip():
+    # Streaming loaders (PDF) return a generator; empty ones just yield no chunks
+    if isinstance(content, str) and not content.strip():
         return []
 
     # Chunk the content immediately using our optimized generator
-    # We convert the generator to a list here because we need to return data to the thread
+    # We convert the generator to a list here because we need to return data to the parent process
     chunks = []
     chunk_generator = smart_chunk_text(content, max_chars=500)
     
@@ -124,58 +168,148 @@ def process_file(file_path: str) -> List[Dict[str, Any]]:
     
     return chunks
 
+async def _ingest_pipeline(file_hashes: Dict[str, bytes]):
+    """
+    Extracts files in a process pool and streams their chunks through two
+    overlapping stages: embedding (network, Ollama) and Chroma writes
+    (disk/SQLite, in a worker thread). A queue of at most WRITE_QUEUE_SIZE
+    embedded batches sits between them, so the next batch is embedded while
+    the previous one is being written, and embedding backs off if writes lag.
+    """
+    # We process files in chunks to avoid holding everything in RAM
+    current_batch_docs = []
+    pending_files = []  # (digest, path) of files whose chunks are in the current batch
+    seen_chunks = set()  # Chunk ids already queued this run (same path + content)
+
+    # Client and semaphore are shared by every batch on this loop
+    aclient = new_async_client()
+    semaphore = asyncio.Semaphore(MAX_PARALLEL)
+    write_queue = asyncio.Queue(maxsize=WRITE_QUEUE_SIZE)
+
+    async def writer():
+        # None is the end-of-stream marker
+        while (item := await write_queue.get()) is not None:
+            batch_docs, embeddings, batch_files = item
+            try:
+                # Captured before the write: if /reset runs after it, these
+                # chunks are gone and the files must not be marked ingested
+                generation = get_reset_generation()
+                # Every chunk of a file travels in one batch, so clearing the
+                # files' old chunks first leaves exactly their current version
+                await asyncio.to_thread(delete_paths, [fp for _, fp in batch_files])
+                # add_documents looks the collection up per batch (a cached global),
+                # so a /reset mid-run keeps writing into the re-created collection
+                saved = await asyncio.to_thread(add_documents, batch_docs, embeddings)
+                # Report progress only once the batch is actually stored
+                if batch_docs:
+                    print(f"Ingested {saved} of {len(batch_docs)} chunks...")
+                # Only remember files once every chunk made it in, so failures get retried
+                if saved == len(batch_docs):
+                    await asyncio.to_thread(mark_ingested, batch_files, generation)
+            except Exception as e:
+                print(f"Failed to write batch of {len(batch_docs)} chunks: {e}")
+
+    async def flush(batch_docs):
+        # One batched embedding call, then hand off to the writer.
+        # Files sharing a chunk each keep a row, but its text is embedded once.
+        unique_texts = list(dict.fromkeys(doc["content"] for doc in batch_docs))
+        vectors = dict(zip(unique_texts, await embed_batch_async(unique_texts, aclient, semaphore)))
+        embeddings = [vectors[doc["content"]] for doc in batch_docs]
+        batch_files = list(pending_files)
+        pending_files.clear()
+        await write_queue.put((batch_docs, embeddings, batch_files))
+
+    async def file_result(future, fp):
+        try:
+            return fp, await asyncio.wrap_future(future), None
+        except Exception as e:
+            return fp, None, e
+
+    writer_task = asyncio.create_task(writer())
+    try:
+        # Spawn, not fork: this runs in a uvicorn worker thread next to live
+        # Chroma/httpx threads, and forking a multi-threaded process can leave
+        # a child stuck on a lock (e.g. stdout's) another thread held
+        with ProcessPoolExecutor(
+            max_workers=MAX_WORKERS,
+            mp_context=multiprocessing.get_context("spawn")
+        ) as executor:
+            # Submit all file processing jobs (process_file is module-level, so picklable)
+            results = [
+                file_result(executor.submit(process_file, fp), fp)
+                for fp in file_hashes
+            ]
+
+            for next_result in asyncio.as_completed(results):
+                fp, file_chunks, error = await next_result
+                if error is not None:
+                    # Not recorded as ingested, so the next run retries it
+                    print(f"Failed to process {fp}: {error}")
+                    continue
+
+                pending_files.append((file_hashes[fp], fp))
+                for chunk in file_chunks:
+                    doc_id = chunk_id(chunk["path"], chunk["content"])
+                    if doc_id not in seen_chunks:
+                        seen_chunks.add(doc_id)
+                        current_batch_docs.append(chunk)
+
+                # 3. Batch Insert
+                # Once we have a large batch, embed it and queue it for the DB
+                if len(current_batch_docs) >= INGEST_BATCH_SIZE:
+                    await flush(current_batch_docs)
+                    current_batch_docs = []  # Clear memory
+
+        # 4. Final Flush
+        # Also runs with no chunks left, so files that produced no new chunks
+        # still get recorded as ingested
+        if current_batch_docs or pending_files:
+            await flush(current_batch_docs)
+    finally:
+        await write_queue.put(None)
+        await writer_task
+        # Release the pooled connections before asyncio.run closes this loop
+        await close_async_client(aclient)
+
 def run_ingestion(folder_path: str):
     """
     Top 1% Feature: Parallel Ingestion Pipeline.
     1. Finds all files.
-    2. Reads & Chunks them in parallel (ThreadPool).
-    3. Batches them to the Vector Database.
+    2. Reads & Chunks them in parallel (ProcessPool, sidesteps the GIL).
+    3. Embeds and batches them to the Vector Database in this process,
+       while the workers keep extracting the remaining files; Chroma writes
+       overlap with embedding of the next batch.
     """
     if not os.path.exists(folder_path):
         print(f"Folder not found: {folder_path}")
         return
 
     # 1. Collect all file paths first (Fast)
-    all_files = []
-    for root, dirs, files in os.walk(folder_path):
-        dirs[:] = [d for d in dirs if d not in EXCLUDE_DIRS]
-        for file in files:
-            ext = os.path.splitext(file)[1].lower()
-            if ext in SUPPORTED_EXTENSIONS:
-                all_files.append(os.path.join(root, file))
+    all_files = list(iter_supported_files(folder_path))
 
     print(f"Found {len(all_files)} files. Starting ingestion...")
 
-    # 2. Parallel Processing
-    # We process files in chunks to avoid holding everything in RAM
-    batch_size = 50  # Number of files to process before writing to DB
-    current_batch_docs = []
-    
-    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
-        # Submit all file processing jobs
-        future_to_file = {executor.submit(process_file, fp): fp for fp in all_files}
+    # Skip files whose exact bytes were already ingested (this run or a previous one)
+    seen_hashes = load_ingested_hashes()
+    file_hashes = {}
+    for fp in all_files:
+        try:
+            digest = file_digest(fp)
+        except OSError as e:
+            print(f"Failed to hash {fp}: {e}")
+            continue
+        if digest in seen_hashes:
+            continue
+        seen_hashes.add(digest)
+        file_hashes[fp] = digest
 
-        for future in as_completed(future_to_file):
-            try:
-                # Get chunks from a single file
-                file_chunks = future.result()
-                current_batch_docs.extend(file_chunks)
-
-                # 3. Micro-Batch Insert
-                # If we have enough chunks, write to DB immediately
-                if len(current_batch_docs) >= 100:
-                    add_documents(current_batch_docs)
-                    print(f"Ingested {len(current_batch_docs)} chunks...")
-                    current_batch_docs = []  # Clear memory
-
-            except Exception as e:
-                fp = future_to_file[future]
-                print(f"Failed to process {fp}: {e}")
+    skipped = len(all_files) - len(file_hashes)
+    if skipped:
+        print(f"Skipping {skipped} duplicate or already-ingested files.")
 
-    # 4. Final Flush
-    if current_batch_docs:
-        add_documents(current_batch_docs)
-        print(f"Ingested final {len(current_batch_docs)} chunks.")
+    # 2. Parallel Processing + Pipelined Embedding/Insert
+    # One event loop for the whole run (asyncio.run), instead of a loop per batch
+    asyncio.run(_ingest_pipeline(file_hashes))
 
     print("Ingestion complete.")
 